@@ -2,73 +2,141 @@
 Main bot file. This file contains the main bot loop and the main functions to process the jobs.
 """
 import asyncio
-import glob
-import json
+import io
 import math
 import os
+import pathlib
 import platform
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import traceback
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from multiprocessing.connection import Listener
 from typing import Any, Optional
 
+import orjson
 from aiohttp.client_exceptions import ClientConnectorError
 from nextcord.ext.ipc.client import Client
 from openai import OpenAI
 
-from data_structure.Jobs import Job
+from data_structure.Jobs import Job, ProjectFiles
 from data_structure.PriorityQueue import StepQueue
 from plib import terminal
 from plib.db_handler import Database as Db
 from plib.terminal import error
 
-STEPS_CHART = {
-    0: "Generate project files/structure",
-    1: "Compilation test",
-    2: "Running test cases",
-    3: "Abstraction test",
-    4: "ChatGPT consolidation",
-    5: "Send to user"
-}
+# Indexed by step.
+STEPS_CHART: tuple[str, ...] = (
+    "Generate project files/structure",
+    "Compilation test",
+    "Running test cases",
+    "Abstraction test",
+    "ChatGPT consolidation",
+    "Send to user"
+)
+
+# Evaluated once at import, platform.system() is not free and the OS does not change at runtime.
+_PLATFORM = platform.system()
+_IS_WINDOWS = _PLATFORM == "Windows"
+
+if _IS_WINDOWS:
+    SHELL_PREFIX: Optional[list[str]] = ["cmd.exe", "/C"]
+elif _PLATFORM == "Linux":
+    SHELL_PREFIX = ["/bin/bash", "-c"]
+else:
+    SHELL_PREFIX = None
+
+# Safety net for the queue waiters, in seconds. Workers are woken up by the queue itself.
+WAIT_TIMEOUT = 30
+
+# Sent back to the user when a step fails with an unexpected exception.
+UNEXPECTED_ERROR_TEXT = "Ha ocurrido un error inesperado al procesar el ejercicio. Si el error persiste, contacta a un administrador."
+
+# Blocking work (subprocesses, file system, database, HTTP) runs here, so the event loop is never blocked.
+EXECUTOR = ThreadPoolExecutor(max_workers=3)
+
+# Removes the directories of the finished jobs in the background, so sending the next job is not delayed.
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# Extracted exercises, shared by every job of the same exercise. Refreshed at least every EXERCISE_CACHE_TTL seconds.
+EXERCISE_CACHE_PATH = os.path.join(tempfile.gettempdir(), "DawBotcodingGym", "exercise_cache")
+EXERCISE_CACHE_TTL = 600
+_EXERCISE_CACHE_LOCK = threading.Lock()
+# Position of the zip in an EXERCISE register.
+EXERCISE_FILE_INDEX = 6
+
+# Parsed exercise JSON files, see load_exercise_json(). Keyed by (category, id_exec, ttl_bucket, name).
+EXERCISE_JSON_FILES = ("test_cases.json", "abstraction.json")
+EXERCISE_JSON_CACHE_SIZE = 128
+_EXERCISE_JSON_CACHE: dict[tuple[str, int, int, str], Any] = {}
+
+# Created once by get_openai_client() and shared by every job, so the HTTP connection pool is reused.
+_OPENAI_CLIENT: Optional[OpenAI] = None
 
 async def main():
     """
     Main function to start the bot.
     """
     try:
-        with open("credentials.txt", "r", encoding="utf-8") as f:
-            
-            CREDENTIALS = f.read().splitlines()
-            os.environ["IPC_SECRET_KEY"] = CREDENTIALS[0]
-            os.environ["OPENAI_API_KEY"] = CREDENTIALS[1]
+        credentials = pathlib.Path("credentials.txt").read_text(encoding="utf-8")
     except FileNotFoundError:
         print("It seems that you don't have the required files. Please, read README.md#installation.")
         sys.exit(1)
 
-    sq = StepQueue(len(STEPS_CHART.keys()))
+    credentials = [line.strip() for line in credentials.splitlines()]
+    if len(credentials) < 2 or not credentials[0] or not credentials[1]:
+        print("credentials.txt needs the IPC secret key and the OpenAI API key, one per line. Please, read README.md#installation.")
+        sys.exit(1)
+
+    ipc_key, openai_key = credentials[0], credentials[1]
+    os.environ.update(IPC_SECRET_KEY=ipc_key, OPENAI_API_KEY=openai_key)
+    del credentials
+
+    sq = StepQueue(len(STEPS_CHART))
+
+    tasks = [worker(sq) for _ in range(3)]
 
-    threads = [threading.Thread(target=asyncio.run, args=(worker(sq),)) for _ in range(3)]
+    tasks.append(updater(sq, ipc_key))
 
-    threads.append(threading.Thread(target=asyncio.run, args=(updater(sq, CREDENTIALS[0]),)))
+    tasks.append(worker_done_job(sq))
 
-    threads.append(threading.Thread(target=asyncio.run, args=(worker_done_job(sq),)))
+    tasks.append(done_loop(sq, ipc_key))
 
-    print(f"Created {len(threads)} threads.")
+    print(f"Created {len(tasks)} tasks.")
 
-    for thread in threads:
-        thread.start()
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        sq.close()
+
+async def done_loop(sq: StepQueue, key: str):
+    """
+    Done loop function. This function sends the finished jobs (last step) back to the main DAW bot through IPC.
+
+    Gives up after 10 consecutive failed tries to reach the IPC server.
+    The same IPC client is kept for every job, it is only reset when the connection fails.
     
+    Parameters
+    ----------
+    sq : `StepQueue`
+        The step queue to process the jobs.
+    key : `str`
+        The key to authenticate the IPC connection.
+    """
     print("Starting main loop...")
-    ipc_client = Client(secret_key=CREDENTIALS[0])
+    ipc_client = Client(secret_key=key)
     failed_tries = 0
     while failed_tries < 10:
 
-        if sq.pause:
-            await asyncio.sleep(5)
+        await sq.wait_for_any([5], timeout=WAIT_TIMEOUT)
 
         data = sq.get_done_job(step=5)
 
@@ -80,8 +148,6 @@ async def main():
         if job is None:
             continue
         
-        if failed_tries > 0:
-            ipc_client = Client(secret_key=CREDENTIALS[0])
         try:
             print("Checking IPC server...")
             ipc_status = await ipc_client.request("status")
@@ -104,8 +170,8 @@ async def main():
                     sq.clear()
                     sys.exit(1)
                 await ipc_client.request("terminateJob", data=payload)
-                sq.snapshot()
-                shutil.rmtree(job.path, ignore_errors=True)
+                sq.finish_job(job)
+                CLEANUP_EXECUTOR.submit(shutil.rmtree, job.path, ignore_errors=True)
                 continue
             failed_tries += 1
             print("IPC server not ready")
@@ -113,21 +179,41 @@ async def main():
         except ClientConnectorError:
             failed_tries += 1
             print("IPC server not responding, trying again in 10 seconds...")
+            await reset_ipc_client(ipc_client)
             await asyncio.sleep(10)
         except ConnectionResetError:
             failed_tries += 1
             print("IPC server connection reseted, trying again in 10 seconds...")
+            await reset_ipc_client(ipc_client)
             await asyncio.sleep(10)
         sq.add_job(step, job)
 
+async def reset_ipc_client(ipc_client: Client):
+    """
+    Reset the IPC client after a connection error.
+
+    Closes the current session, so the next request opens a new connection,
+    instead of creating a new client.
+    
+    Parameters
+    ----------
+    ipc_client : `Client`
+        The IPC client to reset.
+    """
+    if ipc_client.session is not None:
+        await ipc_client.session.close()
+    ipc_client.session = None
+
 async def worker(sq: StepQueue):
     """
-    Main worker function. This function is the main loop for the worker threads.
-    A worker thread is a thread that processes the jobs in the queue.
+    Main worker function. This function is the main loop for the worker tasks.
+    A worker task is a coroutine that processes the jobs in the queue, offloading the blocking work to `EXECUTOR`.
 
-    Recommendation: Worker threads should reach all steps in the queue, but the last two, also known as "done" steps.
+    Recommendation: Worker tasks should reach all steps in the queue, but the last two, also known as "done" steps.
 
-    Jobs being None: This happens when the queue receives a new job, and therefore unlocks the worker threads.
+    Waiting: The worker suspends until the queue receives a job in any of its steps, instead of polling.
+
+    Jobs being None: This happens when the queue receives a new job, and therefore unlocks the worker tasks.
     Many workers will try to pull the job, but only one will get it.
     (If there is only one job and if there is many workers)
     
@@ -136,14 +222,8 @@ async def worker(sq: StepQueue):
     sq : `StepQueue`
         The step queue to process the jobs.
     """
-    cooldown = 0
     while True:
-        if sq.pause:
-            await asyncio.sleep(3)
-            if cooldown < 3:
-                cooldown += 1
-                continue
-            cooldown = 0
+        await sq.wait_for_any([0, 1, 2, 3], timeout=WAIT_TIMEOUT)
     
         data = sq.get_next_job()
 
@@ -153,17 +233,17 @@ async def worker(sq: StepQueue):
             if job is None:
                 continue
             
-            process_job(job, step, sq)
-
-        await asyncio.sleep(0.2)
+            await process_job(job, step, sq)
 
 async def worker_done_job(sq: StepQueue):
     """
-    Special worker function. This function is the main loop for the done job worker threads.
+    Special worker function. This function is the main loop for the done job worker task.
+
+    Recommendation: Done job worker tasks should only reach the last two steps in the queue, also known as "done" steps.
 
-    Recommendation: Done job worker threads should only reach the last two steps in the queue, also known as "done" steps.
+    Waiting: The worker suspends until the queue receives a job in the consolidation step, instead of polling.
 
-    Jobs being None: This happens when the queue receives a new job, and therefore unlocks the worker threads.
+    Jobs being None: This happens when the queue receives a new job, and therefore unlocks the worker tasks.
     Many workers will try to pull the job, but only one will get it.
     (If there is only one job and if there is many workers)
     
@@ -172,14 +252,8 @@ async def worker_done_job(sq: StepQueue):
     sq : `StepQueue`
         The step queue to process the jobs.
     """
-    cooldown = 0
     while True:
-        if sq.pause_done:
-            await asyncio.sleep(3)
-            if cooldown < 3:
-                cooldown += 1
-                continue
-            cooldown = 0
+        await sq.wait_for_any([4], timeout=WAIT_TIMEOUT)
 
         data = sq.get_done_job(step=4)
 
@@ -191,15 +265,14 @@ async def worker_done_job(sq: StepQueue):
                 continue
 
             await process_done_job(job, step, sq)
-        
-        await asyncio.sleep(0.2)
 
-def process_job(job: Job, step: int, sq: StepQueue):
+async def process_job(job: Job, step: int, sq: StepQueue):
     """
     Process a job in the queue, based on the step it is in.
 
     Normally, after processing the job, the function should add the job to the step queue again.
     The step at which the job is added depends on the result of the processing, usually relaying on job.broken.
+    Blocking steps run on `EXECUTOR`, the test cases run as asyncio subprocesses.
 
     Step 0: Generate project files/structure
     Step 1: Compilation test
@@ -216,39 +289,46 @@ def process_job(job: Job, step: int, sq: StepQueue):
         The step queue to process the jobs.
     """
     print(f"Starting job with id= {job.id_exec} for user {job.id_user} at {job.path} on step {step}, which is '{STEPS_CHART[step]}'")
+    loop = asyncio.get_running_loop()
     
-    if step == 0:
-        status = generate_project_files(job)
-        if not status:
-            step = 5
-            job.broken = True
-            job.text_content = "No se han podido generar los archivos del proyecto. Si el error persiste, contacta a un administrador."
-        else:
-            step += 1
-    elif step == 1:
-        status, result = compilation_test(job)
-        if not status:
-            step = 4
-            job.broken = True
-            job.text_content = result[-1000:]
-        else:
-            step += 1
-    elif step == 2:
-        status = running_test(job)
-        if status == 0:
-            step += 1
-        elif status == 1:
-            step = 4
-        else:
-            step = 5
-
-    elif step == 3:
-        score, banned_found = abstraction_test(job)
-        job.abstraction_score = score
-        job.banned_found = banned_found
-        step += 2
+    try:
+        if step == 0:
+            status = await loop.run_in_executor(EXECUTOR, generate_project_files, job)
+            if not status:
+                step = 5
+                job.broken = True
+                job.text_content = "No se han podido generar los archivos del proyecto. Si el error persiste, contacta a un administrador."
+            else:
+                step += 1
+        elif step == 1:
+            status, result = await loop.run_in_executor(EXECUTOR, compilation_test, job)
+            if not status:
+                step = 4
+                job.broken = True
+                job.text_content = result[-1000:]
+            else:
+                step += 1
+        elif step == 2:
+            status = await running_test(job)
+            if status == 0:
+                step += 1
+            elif status == 1:
+                step = 4
+            else:
+                step = 5
+
+        elif step == 3:
+            score, banned_found = await loop.run_in_executor(EXECUTOR, abstraction_test, job)
+            job.abstraction_score = score
+            job.banned_found = banned_found
+            step += 2
+    except Exception as e: # pylint: disable=broad-exception-caught
+        # A bad job must not take the other tasks down with it.
+        error(e, message=f"Job {job.id_exec} failed on step {step}", level="ERROR")
+        job.broken = True
+        job.text_content = UNEXPECTED_ERROR_TEXT
+        step = 5
     sq.add_job(step, job)
-    sq.snapshot() 
 
 async def process_done_job(job: Job, step: int, sq: StepQueue):
     """
@@ -272,16 +352,22 @@ async def process_done_job(job: Job, step: int, sq: StepQueue):
     print(f"Payloading Done Jobs {job.id_exec} for user {job.id_user} at {job.path} on step {step}, which is '{STEPS_CHART[step]}'")
     
     if step == 4:
-        chatgpt_consolidation(job)
+        try:
+            await asyncio.get_running_loop().run_in_executor(EXECUTOR, chatgpt_consolidation, job)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            # The job is still sent back, without the consolidation.
+            error(e, message=f"Job {job.id_exec} failed on step {step}", level="ERROR")
+            job.broken = True
+            if not job.text_content:
+                job.text_content = UNEXPECTED_ERROR_TEXT
         sq.add_job(step + 1, job)
-        sq.snapshot()
     # elif step == 5:
     #     status = await terminateJob(job)
     #     if not status:
     #         sq.addJob(step, job)
     #     sq.snapshot()
 
-def generate_project_files(job: Job, attempt: int = 0):
+def generate_project_files(job: Job):
     """
     Generate the project files for the user and the exercise.
 
@@ -299,16 +385,6 @@ def generate_project_files(job: Job, attempt: int = 0):
     if db is None:
         job.broken = True
         return False
-    
-    try:    
-        ex_data = db.select("EXERCISE", {"id": job.id_exec, "type": job.category})[0]
-    except IndexError:
-        if attempt < 3:
-            db.connect()
-            return generate_project_files(job, attempt + 1)
-        job.broken = True
-        job.text_content = "No se ha encontrado el ejercicio. Si el error persiste, contacta a un administrador."
-        return False
 
     path = job.path
 
@@ -320,29 +396,73 @@ def generate_project_files(job: Job, attempt: int = 0):
     
     if not os.path.exists(exercise_path):
         os.makedirs(exercise_path)
+    
+    try:
+        with _EXERCISE_CACHE_LOCK:
+            ttl_bucket = int(time.monotonic() // EXERCISE_CACHE_TTL)
+            cached_path = cached_exercise_path(job.id_exec, job.category, ttl_bucket)
+            if not os.path.isdir(cached_path):
+                # Removed from disk behind our back (e.g. temporary files cleanup).
+                cached_exercise_path.cache_clear()
+                cached_path = cached_exercise_path(job.id_exec, job.category, ttl_bucket)
+
+            # Copied, not linked: the user code runs next to these files and must not be able to change the cache.
+            shutil.copytree(cached_path, exercise_path, dirs_exist_ok=True)
+    except IndexError:
+        # The pool reconnects dropped connections by itself, a missing exercise is just missing.
+        job.broken = True
+        job.text_content = "No se ha encontrado el ejercicio. Si el error persiste, contacta a un administrador."
+        return False
 
-    ex_id: int =           ex_data[0] # type: ignore
-    ex_type: str =         ex_data[1] # type: ignore
-    ex_title: str =        ex_data[2] # type: ignore
-    ex_description: str =  ex_data[3] # type: ignore
-    ex_difficulty:int =    ex_data[4] # type: ignore
-    ex_content: str =      ex_data[5] # type: ignore
-    ex_file: bytes =       ex_data[6] # type: ignore
+    return True
 
-    with open(os.path.join(exercise_path, f"{ex_id}.zip"), "wb") as f:
-        f.write(ex_file)
-    shutil.unpack_archive(os.path.join(exercise_path, f"{ex_id}.zip"), exercise_path)
-    os.remove(os.path.join(exercise_path, f"{ex_id}.zip"))
+@lru_cache(maxsize=64)
+def cached_exercise_path(id_exec: int, category: str, ttl_bucket: int) -> str:
+    """
+    Extract the exercise files into the exercise cache and return their directory.
 
-    return True
+    Cached per exercise, so the exercise is only pulled from the database and extracted once.
+    Only successful extractions are cached, errors are raised to the caller.
+    Should be called while holding `_EXERCISE_CACHE_LOCK`.
+
+    Warning: As special format, only supports zip.
+    
+    Parameters
+    ----------
+    id_exec : `int`
+        The id of the exercise.
+    category : `str`
+        The category (type) of the exercise.
+    ttl_bucket : `int`
+        The current time bucket, see `EXERCISE_CACHE_TTL`. A new bucket extracts the exercise again.
+    
+    Returns
+    -------
+    `str`
+        The directory with the extracted exercise files.
+    
+    Raises
+    ------
+    `IndexError`
+        If the exercise is not found in the database.
+    """
+    ex_file: bytes = db.select("EXERCISE", {"id": id_exec, "type": category})[0][EXERCISE_FILE_INDEX] # type: ignore
 
-    # Generate user files
-    # zip_files = glob.glob(os.path.join(user_path, "**/*.zip"), recursive=True)
-    # rar_files = glob.glob(os.path.join(user_path, "**/*.rar"), recursive=True)
+    exercise_path = os.path.join(EXERCISE_CACHE_PATH, f"{category}_{id_exec}")
+    shutil.rmtree(exercise_path, ignore_errors=True)
+    os.makedirs(exercise_path)
 
-    # for file in zip_files + rar_files:
-    #     shutil.unpack_archive(file, user_path)
-    #     os.remove(file)
+    # The zip is already in memory, no need to write it to disk just to read it back.
+    with zipfile.ZipFile(io.BytesIO(ex_file)) as zip_file:
+        zip_file.extractall(exercise_path)
+
+    # Parsed now, before any job gets a copy of the files, see load_exercise_json().
+    for name in EXERCISE_JSON_FILES:
+        json_path = os.path.join(exercise_path, name)
+        if os.path.isfile(json_path):
+            _store_exercise_json((category, id_exec, ttl_bucket, name), json_path)
+
+    return exercise_path
 
 def compilation_test(job: Job):
     """
@@ -368,44 +488,32 @@ def compilation_test(job: Job):
     """
     path = os.path.join(job.path, str(job.id_user))
 
-    java_files = glob.glob(os.path.join(path, "**/*.java"), recursive=True)
+    files = scan_project(path)
+    job.project_files = files
+    project_type, directory, java_files = detect_project_type(files)
 
-    if platform.system() == "Windows":
-        command = ["cmd.exe", "/C"]
-    elif platform.system() == "Linux":
-        command = ["/bin/bash", "-c"]
-    else:
+    if SHELL_PREFIX is None:
         raise NotImplementedError("Unsupported OS")
+    command = list(SHELL_PREFIX)
     
     shutil.rmtree(os.path.join(path, "build"), ignore_errors=True)
 
-    project_type = None
-
     if not java_files:
         return (False, "No Java files found for compilation.")
-    
-    directory = None
 
-    if isant_project(path):
+    if project_type == "Ant":
         command += ["ant"]
-        file_path = glob.glob(os.path.join(path, "**/build.xml"), recursive=True)[0]
-        directory = os.path.dirname(file_path)
-        project_type = "Ant"
-    elif ismaven_project(path):
-        if platform.system() == "Windows":
+    elif project_type == "Maven":
+        if _IS_WINDOWS:
             command += ["mvn", "verify"]
         else:
             command += ["mvn verify"]
-        file_path = glob.glob(os.path.join(path, "**/pom.xml"), recursive=True)[0]
-        directory = os.path.dirname(file_path)
-        project_type = "Maven"
-    elif len(java_files) == 1:
+    elif project_type == "Single file":
         build_path = os.path.join(path, "build")
-        if platform.system() == "Windows":
+        if _IS_WINDOWS:
             command += ["javac", "-d", build_path] + java_files
         else:
             command += [f"javac -d {build_path} {' '.join(java_files)}"]
-        project_type = "Single file"
         job.java_file = java_files
     else:
         return (False, "No hemos podido determinar el tipo de proyecto.\nAsegúrate de que el proyecto sea de tipo Ant, Maven o un solo archivo Java.\n" +
@@ -416,45 +524,90 @@ def compilation_test(job: Job):
 
     return compile_command(command, directory)
 
-def isant_project(directory: str) -> bool:
+def scan_project(path: str) -> ProjectFiles:
     """
-    Check if the directory is an Ant project. Simply checks if there are any build.xml files in the directory and its subdirectories.
+    Scan the project directory once, classifying every file of interest.
+
+    Walks the directory tree breadth first with `os.scandir`, so shallower files come first.
+    Symbolic links to directories are not followed, and hidden files and directories are skipped (as glob does).
     
     Parameters
     ----------
-    directory : `str`
-        The directory to check.
+    path : `str`
+        The directory to scan.
     
     Returns
     -------
-    `bool`
-        True if the directory is an Ant project, False otherwise.
+    `ProjectFiles`
+        The Java files, build.xml files, pom.xml files and Main.java files found.
     """
-    build_files = glob.glob(os.path.join(directory, "**/build.xml"), recursive=True)
+    files = ProjectFiles()
+    directories = deque([path])
 
-    if not build_files:
-        return False
-    return True
+    while directories:
+        try:
+            with os.scandir(directories.popleft()) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.endswith(".java"):
+                        files.java.append(entry.path)
+                        if entry.name == "Main.java":
+                            files.main_java.append(entry.path)
+                    elif entry.name == "build.xml":
+                        files.build_xml.append(entry.path)
+                    elif entry.name == "pom.xml":
+                        files.pom_xml.append(entry.path)
+        except OSError:
+            continue
+
+    return files
 
-def ismaven_project(directory: str) -> bool:
+def get_project_files(job: Job) -> ProjectFiles:
     """
-    Check if the directory is a Maven project. Simply checks if there are any pom.xml files in the directory or its subdirectories.
+    Get the scanned files of the user project, scanning it if the job does not have them yet.
     
     Parameters
     ----------
-    directory : `str`
-        The directory to check.
+    job : `Job`
+        The job to process.
     
     Returns
     -------
-    `bool`
-        True if the directory is a Maven project, False otherwise.
+    `ProjectFiles`
+        The scanned files of the user project.
     """
-    pom_files = glob.glob(os.path.join(directory, "**/pom.xml"), recursive=True)
+    if job.project_files is None:
+        job.project_files = scan_project(os.path.join(job.path, str(job.id_user)))
+    return job.project_files
 
-    if not pom_files:
-        return False
-    return True
+def detect_project_type(files: ProjectFiles) -> tuple[Optional[str], Optional[str], list[str]]:
+    """
+    Detect the project type from the scanned files of the project, without walking the directory again.
+
+    Ant projects have a build.xml file, Maven projects have a pom.xml file (checked in that order),
+    and single file projects have exactly one Java file.
+    
+    Parameters
+    ----------
+    files : `ProjectFiles`
+        The scanned files of the project, see `scan_project`.
+    
+    Returns
+    -------
+    `tuple[Optional[str], Optional[str], list[str]]`
+        A tuple with the project type ("Ant", "Maven", "Single file" or None if unknown),
+        the directory to build the project in (None if it is not relevant) and the Java files of the project.
+    """
+    if files.build_xml:
+        return ("Ant", os.path.dirname(files.build_xml[0]), files.java)
+    if files.pom_xml:
+        return ("Maven", os.path.dirname(files.pom_xml[0]), files.java)
+    if len(files.java) == 1:
+        return ("Single file", None, files.java)
+    return (None, None, files.java)
 
 def compile_command(command: list[str], directory: Optional[str] = None) -> tuple[bool, str]:
     """
@@ -478,9 +631,12 @@ def compile_command(command: list[str], directory: Optional[str] = None) -> tupl
     except subprocess.CalledProcessError as e:
         return (False, e.stdout + e.stderr)
 
-def running_test(job: Job) -> int:
+async def running_test(job: Job) -> int:
     """
     Run the test cases for the user files.
+
+    The project is run directly (no shell in between), as an asyncio subprocess,
+    so the test cases of different jobs run concurrently without blocking the event loop.
     
     Parameters
     ----------
@@ -494,31 +650,27 @@ def running_test(job: Job) -> int:
         0: All test cases passed.
         1: Some test cases failed.
         -1: Timeout.
-    
-    Raises
-    ------
-    `NotImplementedError`
-        If the OS is not supported. (Should not happen, but just in case.)
     """
     
-    exercise_path = os.path.join(job.path, "job_data")
-
-    with open(os.path.join(exercise_path, "test_cases.json"), "r") as f:
-        data = json.load(f)
+    data = load_exercise_json(job, "test_cases.json")
     
     test_cases: list[dict[str, Any]] = data["test_cases"]
 
-    if platform.system() == "Windows":
-        command = ["cmd.exe", "/C"]
-    elif platform.system() == "Linux":
-        command = ["/bin/bash", "-c"]
-    else:
-        raise NotImplementedError("Unsupported OS")
+    # Prepared once per exercise (the parsed file is cached): the inputs are encoded
+    # and the expected outputs compiled, so running and comparing the test case do not redo it.
+    for test_case in test_cases:
+        if "_input_bytes" not in test_case:
+            test_case["_input_bytes"] = b"".join((str(input_data) + "\n").encode("utf-8") for input_data in test_case["inputs"])
+        if "_expected_patterns" not in test_case:
+            test_case["_expected_patterns"] = [re.compile(fr"(?<!\w){re.escape(str(line))}(?!\w)", re.IGNORECASE)
+                                               for line in test_case["outputs"]]
+
+    command: list[str] = []
 
     if job.project_type == "Ant":
-        command += ["ant run"]
+        command += ["ant", "run"]
     elif job.project_type == "Maven":
-        main_file = glob.glob(os.path.join(job.path, "**/Main.java"), recursive=True)
+        main_file = get_project_files(job).main_java
         if not main_file:
             job.broken = True
             job.text_content = (
@@ -527,14 +679,18 @@ def running_test(job: Job) -> int:
             )
             return 1
         main_file = main_file[0]
-        main_file_split = main_file.split("\\" if platform.system() == "Windows" else "/")
+        main_file_split = os.path.normpath(main_file).split(os.sep)
         main_file = main_file_split[-2] + "." + main_file_split[-1].replace(".java", "")
-        command += [f"mvn -q exec:java -Dexec.mainClass={main_file}"]
+        command += ["mvn", "-q", "exec:java", f"-Dexec.mainClass={main_file}"]
     elif job.project_type == "Single file":
-        command += [f"java {job.java_file[0]}"]
+        command += ["java", job.java_file[0]]
+
+    if command:
+        # Resolves launchers such as mvn.cmd on Windows, which can not be found without a shell.
+        command[0] = shutil.which(command[0]) or command[0]
 
     for i, test_case in enumerate(test_cases):
-        status, result = run_test_case(test_case, command, job)
+        status, result = await run_test_case(test_case, command, job)
 
         if result is None:
             result = "No se ha obtenido resultado."
@@ -543,9 +699,6 @@ def running_test(job: Job) -> int:
         if len(result) > 600:
             result_truncated = "...[hubo más output aquí arriba]...\n" + result_truncated
 
-        test_input_text = "\n".join(str(x) for x in test_case["inputs"])
-        test_output_text = "\n".join(str(x) for x in test_case["outputs"])
-
         if not status:
             job.broken = True
             if result_truncated == "Timeout":
@@ -553,8 +706,8 @@ def running_test(job: Job) -> int:
                 return -1
             
             job.text_content = (
-                f"Input dado: {test_input_text}\n"
-                f"Output esperado: {test_output_text}\n"
+                f"Input dado: {format_test_values(test_case['inputs'])}\n"
+                f"Output esperado: {format_test_values(test_case['outputs'])}\n"
                 f"Output obtenido: {result_truncated}\n"
             )
             return 1
@@ -563,7 +716,7 @@ def running_test(job: Job) -> int:
         if job.project_type == "Ant":
             obtained_lines = [line.removeprefix("[java]") for line in obtained_lines if line.strip().startswith("[java]")]
 
-        if not compare_results(test_case["outputs"], obtained_lines):
+        if not compare_results(test_case["_expected_patterns"], obtained_lines):
             
             obtained_lines_text = "\n".join(obtained_lines) + "\n\n(Deberían haber tantas líneas de output obtenido casi como líneas de input dado y output esperado)"
             result_truncated = obtained_lines_text[-600:]
@@ -573,8 +726,8 @@ def running_test(job: Job) -> int:
             job.broken = True
             job.text_content = (
                 f"{i} pruebas superadas hasta el primer fallo.\n"
-                f"Input dado: \n{test_input_text}\n"
-                f"Output esperado: \n{test_output_text}\n"
+                f"Input dado: \n{format_test_values(test_case['inputs'])}\n"
+                f"Output esperado: \n{format_test_values(test_case['outputs'])}\n"
                 f"Output obtenido: \n{result_truncated}\n"
             )
             return 1
@@ -585,19 +738,104 @@ def running_test(job: Job) -> int:
         job.text_content = f"Todos los test correctos, {len(test_cases)} en total."
     return 0
 
-def run_test_case(test_case: dict, command: list[str], job: Job) -> tuple[bool, str]:
+def load_exercise_json(job: Job, name: str) -> Any:
+    """
+    Get a JSON file of the exercise, as parsed when the exercise was extracted (see `cached_exercise_path`).
+
+    The copy in the job_data directory of the job is never read: the user code runs next to it,
+    so it could have been changed (e.g. emptying the test cases).
+    If the parsed file is no longer cached, it is parsed again from the exercise cache.
+
+    Warning: The returned data is shared between jobs, it must only be extended with data derived from the exercise itself.
+    
+    Parameters
+    ----------
+    job : `Job`
+        The job to process.
+    name : `str`
+        The name of the JSON file. ej: "test_cases.json"
+    
+    Returns
+    -------
+    `Any`
+        The parsed JSON file.
+
+    Raises
+    ------
+    `FileNotFoundError`
+        If the exercise does not have that file.
+    """
+    ttl_bucket = int(time.monotonic() // EXERCISE_CACHE_TTL)
+    key = (job.category, job.id_exec, ttl_bucket, name)
+
+    data = _EXERCISE_JSON_CACHE.get(key)
+    if data is None:
+        with _EXERCISE_CACHE_LOCK:
+            data = _EXERCISE_JSON_CACHE.get(key)
+            if data is None:
+                exercise_path = cached_exercise_path(job.id_exec, job.category, ttl_bucket)
+                if not os.path.isdir(exercise_path):
+                    # Removed from disk behind our back (e.g. temporary files cleanup).
+                    cached_exercise_path.cache_clear()
+                    exercise_path = cached_exercise_path(job.id_exec, job.category, ttl_bucket)
+                data = _EXERCISE_JSON_CACHE.get(key)
+                if data is None:
+                    data = _store_exercise_json(key, os.path.join(exercise_path, name))
+    return data
+
+def _store_exercise_json(key: tuple[str, int, int, str], path: str) -> Any:
+    """
+    Parse a JSON file of the exercise cache and keep it in `_EXERCISE_JSON_CACHE`.
+    
+    Parameters
+    ----------
+    key : `tuple[str, int, int, str]`
+        The category, id and time bucket of the exercise, and the name of the file.
+    path : `str`
+        The path of the file, in the exercise cache.
+    
+    Returns
+    -------
+    `Any`
+        The parsed JSON file.
+    """
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
+    if len(_EXERCISE_JSON_CACHE) >= EXERCISE_JSON_CACHE_SIZE:
+        _EXERCISE_JSON_CACHE.clear()
+    _EXERCISE_JSON_CACHE[key] = data
+    return data
+
+def format_test_values(values: list) -> str:
+    """
+    Format the inputs or outputs of a test case, one per line, to report a failed test case.
+    Only called when a test case fails, as passing test cases do not need it.
+    
+    Parameters
+    ----------
+    values : `list`
+        The inputs or outputs of the test case.
+    
+    Returns
+    -------
+    `str`
+        The values, one per line.
+    """
+    return "\n".join(str(x) for x in values)
+
+async def run_test_case(test_case: dict, command: list[str], job: Job) -> tuple[bool, str]:
     """
     Run a test case with the given command.
 
-    Uses subprocess to run the command and send the input to the process.
+    Uses an asyncio subprocess to run the command and send the input to the process.
     Sends all the inputs in the test case to the process and then waits for the process to complete.
     
     Parameters
     ----------
     test_case : `dict`
-        The test case to run.
+        The test case to run, with its inputs already encoded in "_input_bytes".
     command : `list[str]`
-        The command to run. Has to include what shell to use.
+        The command to run, as arguments. It is executed directly, without a shell.
     job : `Job`
         The job to process.
     
@@ -609,35 +847,40 @@ def run_test_case(test_case: dict, command: list[str], job: Job) -> tuple[bool,
    
     cwd = os.path.join(job.path, str(job.id_user))
 
+    # Unknown project type, there is nothing to run.
+    if not command:
+        return (False, "No se ha podido ejecutar el proyecto. Error inesperado.")
+
     # Start the process
-    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT, cwd=cwd)
+    except (OSError, ValueError):
+        return (False, "No se ha podido ejecutar el proyecto. Error inesperado.")
 
     if process.stdin is None:
         return (False, "No se ha podido ejecutar el proyecto. Error inesperado.")
 
-    # Send input to the Ant project
-    for input_data in test_case["inputs"]:
-        input_data_bytes = bytes(str(input_data) + "\n", encoding="utf-8")
-        process.stdin.write(input_data_bytes)
-    # process.stdin.close()
+    # All the inputs are sent at once by communicate(), which closes stdin afterwards
+    input_bytes: bytes = test_case["_input_bytes"]
 
     timeout = 60 if job.project_type == "Maven" else 30
 
-    # Read and print the output of the Ant project
     try:
-        # Read and print the output of the Ant project with a timeout
-        output, output_err = process.communicate(timeout=timeout)
+        # Send the input and read the output of the project with a timeout
+        output, output_err = await asyncio.wait_for(process.communicate(input=input_bytes), timeout)
         if output is not None:
             output = output.decode("UTF-8", errors="replace")
         if output_err is not None:
             output_err = output_err.decode("UTF-8", errors="replace")
 
-        # Wait for the process to complete
-        exit_code = process.wait()
+        exit_code = process.returncode
 
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         # Kill the process if it takes too long
         process.kill()
+        await process.wait()
         print(f"Process killed due to timeout. Timeout: {timeout} seconds.")
         return (False, "Timeout")
     
@@ -645,14 +888,15 @@ def run_test_case(test_case: dict, command: list[str], job: Job) -> tuple[bool,
         return (True, output)
     return (False, output if output_err is None else output_err)
 
-def compare_results(expected: list[str], obtained_lines: list[str]) -> bool:
+def compare_results(expected: list[re.Pattern], obtained_lines: list[str]) -> bool:
     """
     Compare the expected results with the obtained results.
 
     For each expected result, it tries to find it in the obtained results.
     If found, it removes the result from the obtained results (making it unavailable for the next expected result).
+    The earliest match is always the one removed, so the order of the results does not matter.
 
-    Warning: This function is case insensitive (not case sensitive).
+    Warning: This function is case insensitive (not case sensitive), as the expected patterns are compiled with re.IGNORECASE.
     Warning: This function uses regular expressions to find the expected results in the obtained results.
     Warning: The obtained results could have incorrect results, but still pass this function.
     As it only checks if the expected results are in the obtained results, not if the obtained results are correct.
@@ -660,8 +904,8 @@ def compare_results(expected: list[str], obtained_lines: list[str]) -> bool:
 
     Parameters
     ----------
-    expected : `list[str]`
-        The expected results.
+    expected : `list[re.Pattern]`
+        The expected results, compiled as whole-word, case insensitive patterns (see `running_test`).
     obtained_lines : `list[str]`
         The obtained results.
     
@@ -672,15 +916,12 @@ def compare_results(expected: list[str], obtained_lines: list[str]) -> bool:
     """
     obtained_text: str = "\n".join(obtained_lines)
 
-    for i, line in enumerate(expected):
-        line = str(line)
-        found = re.search(fr"(?<!\w){re.escape(line)}(?!\w)", obtained_text, re.IGNORECASE)
+    for pattern in expected:
+        found = pattern.search(obtained_text)
         if found is None:
             return False
 
-        target_index = found.start()
-        
-        obtained_text = obtained_text[:target_index] + obtained_text[target_index + len(line):]
+        obtained_text = obtained_text[:found.start()] + obtained_text[found.end():]
     
     return True
 
@@ -701,12 +942,7 @@ def abstraction_test(job: Job) -> tuple[float, list[str]]:
         The score is a percentage of the required patterns found in the code.
         The banned patterns are the patterns found in the code that should not be there (does not affect the score).
     """
-    exercise_path = os.path.join(job.path, "job_data")
-
-    path = os.path.join(job.path, str(job.id_user))
-
-    with open(os.path.join(exercise_path, "abstraction.json"), "r") as f:
-        data: dict = json.load(f)
+    data: dict = load_exercise_json(job, "abstraction.json")
     
     required: dict[str, int] = data["required"]
     required_found: dict[str, int] = {}
@@ -714,14 +950,17 @@ def abstraction_test(job: Job) -> tuple[float, list[str]]:
     banned: list[str] = data["banned"]
     banned_found: list[str] = []
 
-    total_code = str()
-    java_files = glob.glob(os.path.join(path, "**/*.java"), recursive=True)
+    # Read as bytes and decoded once, invalid UTF-8 (e.g. sources saved as Latin-1) is replaced instead of failing the job.
+    code_parts: list[bytes] = []
+    java_files = get_project_files(job).java
     for file in java_files:
-        with open(file, "r", encoding="utf-8") as f:
-            total_code += f.read()
+        with open(file, "rb") as f:
+            code_parts.append(f.read())
+    total_code = b"".join(code_parts).decode("utf-8", errors="replace")
     
+    # Required patterns are literals, str.count finds the same non-overlapping matches as an escaped regex.
     for key in required.keys():
-        required_found[key] = len(re.findall(re.escape(key), total_code))
+        required_found[key] = total_code.count(key)
     
     for value in banned:
         if re.search(value, total_code):
@@ -747,7 +986,7 @@ def chatgpt_consolidation(job: Job):
         The job to process.
     """
     try:
-        client = OpenAI(api_key= os.environ.get("OPENAI_API_KEY"))
+        client = get_openai_client()
         completion = client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
@@ -766,11 +1005,27 @@ def chatgpt_consolidation(job: Job):
         print(e)
         job.gpt_content = "No se pudo obtener respuesta de ChatGPT"   
 
+def get_openai_client() -> OpenAI:
+    """
+    Get the shared OpenAI client, creating it on the first call.
+
+    Returns
+    -------
+    `OpenAI`
+        The OpenAI client, authenticated with the OPENAI_API_KEY environment variable.
+    """
+    global _OPENAI_CLIENT # pylint: disable=global-statement
+    if _OPENAI_CLIENT is None:
+        _OPENAI_CLIENT = OpenAI(api_key= os.environ.get("OPENAI_API_KEY"))
+    return _OPENAI_CLIENT
+
 async def updater(sq: StepQueue, key: str):
     """
     The updater function. This function listens for new jobs to be added to the queue.
 
-    A listener thread waiting for new jobs, sended by the main DAW bot.
+    A listener task waiting for new jobs, sended by the main DAW bot.
+    The listener is blocking, so accepting and receiving runs on the default executor,
+    not on `EXECUTOR`, which is reserved for the jobs.
     
     Parameters
     ----------
@@ -782,12 +1037,13 @@ async def updater(sq: StepQueue, key: str):
     print("Starting updater...")
     address = ('localhost', 6000)
     listener = Listener(address, authkey=key.encode('utf-8'))
+    loop = asyncio.get_running_loop()
     while True:
         try:
-            conn = listener.accept()
+            conn = await loop.run_in_executor(None, listener.accept)
             print ('connection accepted from', listener.last_accepted)
             print("Waiting for message...")
-            msg = conn.recv()
+            msg = await loop.run_in_executor(None, conn.recv)
             
             job = Job(msg['id_exec'], msg["category"], msg['id_user'], msg['path'])
 
@@ -831,4 +1087,8 @@ if __name__ == "__main__":
 
     print("Starting bot...")
 
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    finally:
+        # Finish the pending cleanups before exiting.
+        CLEANUP_EXECUTOR.shutdown(wait=True)
\ No newline at end of file
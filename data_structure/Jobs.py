@@ -2,12 +2,17 @@
 Data structure for Jobs
 """
 
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
 class Job:
     """
     Job class is a data structure that holds the information of a job to be executed.
+
+    Uses `__slots__`, as many jobs could be alive at the same time across the steps.
     """
+    __slots__ = ("id_exec", "category", "id_user", "path", "project_type", "broken", "text_content",
+                 "gpt_content", "java_file", "abstraction_score", "banned_found", "project_files")
+
     def __init__(self, id_exec: int, category: str, id_user: int, path: str):
         self.id_exec = id_exec
         self.category = category
@@ -21,3 +26,58 @@ class Job:
         self.java_file: list[str] = list()
         self.abstraction_score: Optional[float] = None
         self.banned_found: Optional[list[str]] = None
+        self.project_files: Optional[ProjectFiles] = None
+
+    def to_tuple(self) -> tuple:
+        """
+        Get the persistent fields of the job, to be stored in the queue snapshot.
+        `project_files` is left out, as it is a cache that is rebuilt when needed.
+
+        Returns
+        -------
+        `tuple`
+            The fields of the job, in the order expected by `from_tuple`.
+        """
+        return (self.id_exec, self.category, self.id_user, self.path, self.project_type, self.broken,
+                self.text_content, self.gpt_content, self.java_file, self.abstraction_score, self.banned_found)
+
+    @classmethod
+    def from_tuple(cls, fields: Iterable) -> "Job":
+        """
+        Build a job from the fields returned by `to_tuple`.
+
+        Parameters
+        ----------
+        fields : `Iterable`
+            The fields of the job, in the order returned by `to_tuple`.
+
+        Returns
+        -------
+        `Job`
+            The rebuilt job.
+        """
+        (id_exec, category, id_user, path, project_type, broken,
+         text_content, gpt_content, java_file, abstraction_score, banned_found) = fields
+
+        job = cls(id_exec, category, id_user, path)
+        job.project_type = project_type
+        job.broken = broken
+        job.text_content = text_content
+        job.gpt_content = gpt_content
+        job.java_file = java_file
+        job.abstraction_score = abstraction_score
+        job.banned_found = banned_found
+        return job
+
+
+class ProjectFiles:
+    """
+    ProjectFiles class is a data structure that holds the files of interest of a user project.
+
+    It is filled by a single scan of the project directory, so the steps do not need to walk it again.
+    """
+    def __init__(self):
+        self.java: list[str] = list()
+        self.build_xml: list[str] = list()
+        self.pom_xml: list[str] = list()
+        self.main_java: list[str] = list()
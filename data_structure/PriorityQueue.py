@@ -3,38 +3,84 @@ A custom implementation of a thread-safe priority queue using the heapq module.
 
 Then we have the StepQueue class, which is a wrapper around the PriorityQueue class.
 It is used to manage the priority queues for each step in the pipeline.
-It also has the ability to snapshot the current state of the queue and restore it later.
+It also has the ability to persist the current state of the queue and restore it later.
 This is useful for when the program is interrupted and we want to continue from where we left off.
+Every change is appended to a log, and a background thread periodically compacts it into a full snapshot.
 """
 
+import asyncio
 import heapq
+import mmap
 import os
-import pickle
 import platform
 import threading
-from typing import Union
+from contextlib import ExitStack, contextmanager
+from operator import itemgetter
+from typing import BinaryIO, Iterable, Union
 from typing import Optional
+
+import orjson
+
 from data_structure.Jobs import Job
 
+# How often, in seconds, the background thread checks if a compaction is due.
+SNAPSHOT_INTERVAL = 2
+# The log is compacted into a snapshot after this many records.
+SNAPSHOT_THRESHOLD = 256
+
+# Where the snapshot and the log are stored. Resolved once, None if the OS is not supported.
+if platform.system() == "Windows":
+    _TEMP_ROOT: Optional[str] = os.path.join(os.environ["TEMP"], "DawBotcodingGym")
+elif platform.system() == "Linux":
+    _TEMP_ROOT = os.path.join("/tmp", "DawBotcodingGym")
+else:
+    _TEMP_ROOT = None
+
+if _TEMP_ROOT is not None:
+    os.makedirs(_TEMP_ROOT, exist_ok=True)
+
 
 class PriorityQueue:
     """
     PriorityQueue class is a custom implementation of a thread-safe priority queue using the heapq module.
 
-    Could be initialized with a list of tuples, where the first element is the priority and the second is the job.
+    Could be initialized with a list of tuples, where the first element is the priority,
+    the second is the insertion order and the third is the job.
+    Jobs with the same priority are served in insertion order (FIFO), so jobs are never compared.
+
+    Each queue has its own lock, so the queues of different steps do not contend with each other.
+    The lock is reentrant, so a caller could hold it to pair a change with other work (e.g. logging it).
 
     Parameters
     ----------
-    queue : `Optional[list[tuple[int, Job]]]`
-        A list of tuples, where the first element is the priority and the second is the job.
+    queue : `Optional[list[tuple[int, int, Job]]]`
+        A list of tuples, where the first element is the priority, the second is the insertion order and the third is the job.
+        Tuples without insertion order, (priority, job), are also accepted.
     """
 
-    def __init__(self, queue: Optional[list[tuple[int, Job]]] = None):
+    def __init__(self, queue: Optional[list[tuple]] = None):
         if queue is None:
             queue = list()
-        self._queue = queue
+        self._lock = threading.RLock()
+        self._set_queue(queue)
+
+    def _set_queue(self, queue: list[tuple]) -> None:
+        """
+        Set the heap of the queue and the insertion order that follows it.
+        Tuples without insertion order, (priority, job), are upgraded keeping their relative order.
+        
+        Parameters
+        ----------
+        queue : `list[tuple]`
+            The entries of the queue, in any order.
+        """
+        if any(len(entry) == 2 for entry in queue):
+            queue = [(entry[0], i, entry[-1]) for i, entry in enumerate(queue)]
+        heapq.heapify(queue)
+        self._queue: list[tuple[int, int, Job]] = queue
+        self._next_order = max((entry[1] for entry in queue), default=-1) + 1
 
-    def add_job(self, job: Job, priority: int) -> None:
+    def add_job(self, job: Job, priority: int, order: Optional[int] = None) -> int:
         """
         Add a job to the queue with a given priority.
         
@@ -44,8 +90,20 @@ class PriorityQueue:
             The job object to be added to the queue.
         priority : `int`
             The priority of the job, where 0 is the highest priority.
+        order : `Optional[int], optional`
+            The insertion order of the job, used when replaying a log. By default `None`, which takes the next one.
+
+        Returns
+        -------
+        `int`
+            The insertion order of the job, which identifies it in the queue.
         """
-        heapq.heappush(self._queue, (priority, job))
+        with self._lock:
+            if order is None:
+                order = self._next_order
+            self._next_order = max(self._next_order, order + 1)
+            heapq.heappush(self._queue, (priority, order, job))
+            return order
 
     def get_next_job(self) -> Optional[Job]:
         """
@@ -56,12 +114,40 @@ class PriorityQueue:
         `Optional[Job]`
             The next job in the queue, or None if the queue is empty.
         """
-        if self._queue:
-            _, job = heapq.heappop(self._queue)
-            return job
-        else:
+        entry = self._pop_entry()
+        return None if entry is None else entry[2]
+
+    def _pop_entry(self) -> Optional[tuple[int, int, Job]]:
+        """
+        Pop the next entry of the queue, with its priority and insertion order.
+
+        Returns
+        -------
+        `Optional[tuple[int, int, Job]]`
+            The next entry in the queue, or None if the queue is empty.
+        """
+        with self._lock:
+            if self._queue:
+                return heapq.heappop(self._queue)
             return None
 
+    def _remove(self, order: int) -> None:
+        """
+        Remove the entry with the given insertion order, if it is in the queue.
+
+        Parameters
+        ----------
+        order : `int`
+            The insertion order of the entry.
+        """
+        with self._lock:
+            for i, entry in enumerate(self._queue):
+                if entry[1] == order:
+                    self._queue[i] = self._queue[-1]
+                    self._queue.pop()
+                    heapq.heapify(self._queue)
+                    return
+
     def get_length(self):
         """
         Get the length of the queue.
@@ -73,15 +159,30 @@ class PriorityQueue:
         """
         return len(self._queue)
 
+    def __len__(self):
+        return len(self._queue)
+
 
 class StepQueue:
     """
     StepQueue class is a wrapper around the PriorityQueue class.
 
     It is used to manage the priority queues for each step in the pipeline.
-    It also has the ability to snapshot the current state of the queue and restore it later.
+    It also has the ability to persist the current state of the queue and restore it later.
     This is useful for when the program is interrupted and we want to continue from where we left off.
 
+    Every `add_job` is appended to a log (`queue_log`), so persisting a change does not depend on the size of the queue.
+    A pulled job is kept in flight, and it is only logged as removed from its step by the record that re-adds it,
+    or by `finish_job` once it leaves the pipeline. A job being processed when the program is interrupted
+    is therefore restored to the step it was pulled from. A background thread compacts the log into a full snapshot
+    (`queue_snapshot`) once it grows past `SNAPSHOT_THRESHOLD` records. Call `close()` on shutdown to compact it one last time.
+
+    The log starts with its generation number, which is also stored in the snapshot. Compacting bumps it,
+    so a log left over by an interrupted compaction is already in the snapshot and is not replayed.
+
+    There is no lock for the whole StepQueue: each PriorityQueue has its own, the waiters have `_waiters_lock`
+    and the log and the jobs in flight have `_log_lock`. When several are needed, queue locks (by step) are taken before the log lock.
+
     Parameters
     ----------
     steps : `Union[int, list[PriorityQueue]]`
@@ -93,16 +194,23 @@ class StepQueue:
         elif isinstance(steps, list):
             self._queues = [PriorityQueue(queue._queue) for queue in steps]
 
-        self.__transient__ = {'_lock'}
-        self._lock = threading.Lock()
-        self.pause = False
-        self.pause_done = False
+        self._waiters_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future, frozenset[int]]] = []
+        # Pulled jobs not re-added yet, by id(job): the step they were pulled from and their entry there.
+        self._in_flight: dict[int, tuple[int, tuple[int, int, Job]]] = {}
+        self._dirty = 0
+        self._log_generation = 0
+        self._log_file: Optional[BinaryIO] = None
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._stop_snapshots = threading.Event()
 
         self.restore()
 
     def add_job(self, step: int, job: Job, priority=5) -> None:
         """
         Add a job to the queue with a given priority. The job will be added to the queue of the given step.
+        If the job was pulled from a queue, the same log record removes it from there.
         
         Parameters
         ----------
@@ -113,10 +221,80 @@ class StepQueue:
         priority : `int, optional`
             The priority of the job, where 0 is the highest priority. By default `5`.
         """
-        with self._lock:
-            self._queues[step].add_job(job, priority)
-            self.pause = False
-            self.pause_done = False
+        queue = self._queues[step]
+        with queue._lock:
+            order = queue.add_job(job, priority)
+            self._log(("add", step, priority, order, job.to_tuple()), job)
+        self._wake(step)
+
+    def finish_job(self, job: Job) -> None:
+        """
+        Mark a pulled job as finished, once it leaves the pipeline.
+        Until then, the job is restored to the step it was pulled from if the program is interrupted.
+
+        Parameters
+        ----------
+        job : `Job`
+            The job object that was pulled from the queue.
+        """
+        self._log(("done",), job)
+
+    def _wake(self, step: int) -> None:
+        """
+        Wake up every waiter that is waiting for the given step.
+        Must be called after the job is in the queue.
+
+        Waiters could belong to a different event loop (or thread), so the futures
+        are resolved through `call_soon_threadsafe`.
+
+        Parameters
+        ----------
+        step : `int`
+            The step that just received a job.
+        """
+        with self._waiters_lock:
+            pending = []
+            for waiter in self._waiters:
+                loop, future, steps = waiter
+                if step in steps:
+                    loop.call_soon_threadsafe(_resolve, future)
+                else:
+                    pending.append(waiter)
+            self._waiters = pending
+
+    async def wait_for_any(self, steps: Iterable[int], timeout: Optional[float] = None) -> None:
+        """
+        Suspend until any of the given steps has a job, instead of polling the queue.
+
+        Returns immediately if any of the steps already has a job.
+        Returning does not guarantee that a job will be pulled,
+        as other workers could be woken up by the same job.
+
+        Parameters
+        ----------
+        steps : `Iterable[int]`
+            The steps in the pipeline to wait for.
+        timeout : `Optional[float], optional`
+            The maximum time to wait, in seconds, as a safety net. By default `None`, which waits forever.
+        """
+        loop = asyncio.get_running_loop()
+        steps = frozenset(steps)
+
+        # Registered before looking at the queues: a job added after the check is
+        # pushed before its wake up, so it could not slip between them.
+        waiter = (loop, loop.create_future(), steps)
+        with self._waiters_lock:
+            self._waiters.append(waiter)
+
+        try:
+            if not any(len(self._queues[step]) for step in steps):
+                await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._waiters_lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
 
     def get_next_job(self, step: Optional[int] = None) -> Optional[tuple[int, Optional[Job]]]:
         """
@@ -137,26 +315,15 @@ class StepQueue:
         `Optional[tuple[int, Optional[Job]]]`
             A tuple containing the step and the next job in the queue, or None if the queue is empty.
         """
-        with self._lock:
-            if step is None:
-                larger = 0
-                for i, val in enumerate([queue.get_length() for queue in self._queues[:-2]]):
-                    if val > larger:
-                        larger = val
-                        step = i
-
-            if step is None:
-                self.pause = True
+        # The lengths are read without locking. If the chosen queue is emptied
+        # meanwhile, None is returned and the caller just waits again.
+        if step is None:
+            step, length = max(((i, len(queue)) for i, queue in enumerate(self._queues[:-2])),
+                               key=itemgetter(1), default=(None, 0))
+            if length == 0:
                 return None
 
-            queue = self._queues[step]
-            if queue:
-                job = queue.get_next_job()
-                if job is not None:
-                    return step, job
-
-            self.pause = True
-            return None
+        return self._pull(step)
 
     def get_done_job(self, step:int) -> Optional[tuple[int, Optional[Job]]]:
         """
@@ -176,23 +343,35 @@ class StepQueue:
         `Optional[tuple[int, Optional[Job]]]`
             A tuple containing the step and the next job in the queue, or None if the queue is empty.
         """
-        with self._lock:
+        return self._pull(step)
 
-            queue = self._queues[step]
-            if queue:
-                job = queue.get_next_job()
-                if job is not None:
-                    return step, job
+    def _pull(self, step: int) -> Optional[tuple[int, Job]]:
+        """
+        Pull the next job of a step and keep it in flight. Nothing is logged until the job is re-added or finished.
 
-            self.pause_done = True
-            return None
+        Parameters
+        ----------
+        step : `int`
+            The step in the pipeline to pull the job from.
 
-    def generate_temp_path(self):
+        Returns
+        -------
+        `Optional[tuple[int, Job]]`
+            A tuple containing the step and the next job in the queue, or None if the queue is empty.
         """
-        Generate a temporary path to store the snapshot of the queue and return it.
-        Manages various OS paths.
+        queue = self._queues[step]
+        with queue._lock:
+            entry = queue._pop_entry()
+            if entry is None:
+                return None
+            with self._log_lock:
+                self._in_flight[id(entry[2])] = (step, entry)
+            return step, entry[2]
 
-        If already exists, it will return the path.
+    def generate_temp_path(self):
+        """
+        Get the temporary path to store the snapshot of the queue.
+        Manages various OS paths. The path is resolved and created once, on import.
         
         Returns
         -------
@@ -204,56 +383,204 @@ class StepQueue:
         `Exception`
             If the OS is not supported.
         """
-        if (platform.system() == "Windows"):
-            path = os.path.join(os.environ["TEMP"], "DawBotcodingGym")
-
-        elif (platform.system() == "Linux"):
-            path = os.path.join("/tmp", "DawBotcodingGym")
-        else:
+        if _TEMP_ROOT is None:
             raise NotImplementedError("Unsupported OS")
+        return _TEMP_ROOT
+
+    def _log(self, record: tuple, job: Optional[Job] = None) -> None:
+        """
+        Append a change to the log, so it survives an interruption.
+        Must be called while holding the lock of the changed queue, so the log keeps the order of its changes.
+
+        The background compaction thread is started on the first call.
+
+        Parameters
+        ----------
+        record : `tuple`
+            Either `("add", step, priority, order, job.to_tuple())` or `("done",)`.
+        job : `Optional[Job], optional`
+            The job of the record. If it is in flight, the step and order it was pulled from
+            are appended to the record, so it is removed from there when replayed. By default `None`.
+        """
+        with self._log_lock:
+            pulled = self._in_flight.pop(id(job), None) if job is not None else None
+            if pulled is not None:
+                record = (*record, (pulled[0], pulled[1][1]))
+            elif record[0] == "done":
+                return
+            line = orjson.dumps(record) + b"\n"
+            self._log_file.write(line)
+            self._log_file.flush()
+
+            self._dirty += 1
+            if self._snapshot_thread is None:
+                self._snapshot_thread = threading.Thread(target=self._snapshot_loop, name="StepQueue snapshots", daemon=True)
+                self._snapshot_thread.start()
+
+    def _reset_log(self) -> None:
+        """
+        Start an empty log for the current generation. Must be called while holding every lock.
+        """
+        if self._log_file is not None:
+            self._log_file.close()
+        self._log_file = open(os.path.join(self.generate_temp_path(), "queue_log"), "wb")
+        self._log_file.write(orjson.dumps(("log", self._log_generation)) + b"\n")
+        self._log_file.flush()
+        self._dirty = 0
+
+    def _snapshot_loop(self):
+        """
+        The background thread loop. Compacts the log into a snapshot when it has `SNAPSHOT_THRESHOLD` records.
+        """
+        while not self._stop_snapshots.wait(SNAPSHOT_INTERVAL):
+            if self._dirty >= SNAPSHOT_THRESHOLD:
+                self.snapshot()
 
-        if not os.path.exists(path):
-            os.makedirs(path)
-        return path
+    def close(self):
+        """
+        Stop the background compaction, compact the log if it has any record and close it.
+        """
+        self._stop_snapshots.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if self._dirty > 0:
+            self.snapshot()
+        with self._log_lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+
+    @contextmanager
+    def _lock_all(self):
+        """
+        Hold the lock of every queue, by step, and the log lock.
+        """
+        with ExitStack() as stack:
+            for queue in self._queues:
+                stack.enter_context(queue._lock)
+            stack.enter_context(self._log_lock)
+            yield
 
     def snapshot(self):
         """
-        Snapshot the current state of the queue and save it to a file.
+        Snapshot the current state of the queue, save it to a file and truncate the log.
+        Every queue is locked meanwhile, so the snapshot and the log stay consistent.
+        Jobs in flight are saved in the step they were pulled from.
         """
-        with self._lock:
+        with self._lock_all():
             path = self.generate_temp_path()
 
-            with open(os.path.join(path, "queue_snapshot"), "wb") as file:
-                pickle.dump(self, file)
+            queues = [list(queue._queue) for queue in self._queues]
+            for step, entry in self._in_flight.values():
+                queues[step].append(entry)
+
+            self._log_generation += 1
+            data = {
+                "generation": self._log_generation,
+                "queues": queues
+            }
+            with open(os.path.join(path, "queue_snapshot.tmp"), "wb") as file:
+                file.write(orjson.dumps(data, default=Job.to_tuple))
+            os.replace(os.path.join(path, "queue_snapshot.tmp"), os.path.join(path, "queue_snapshot"))
+
+            self._reset_log()
 
     def clear(self):
         """
-        Clear the snapshot of the queue.
+        Clear the snapshot and the log of the queue.
         """
-        with self._lock:
+        with self._lock_all():
             path = self.generate_temp_path()
             if os.path.exists(os.path.join(path, "queue_snapshot")):
                 os.remove(os.path.join(path, "queue_snapshot"))
+            self._log_generation = 0
+            self._reset_log()
 
     def restore(self):
         """
-        Restore the snapshot of the queue and load it from a file.
+        Restore the snapshot of the queue from a file, then replay the log on top of it.
         """
-        with self._lock:
+        with self._lock_all():
             path = self.generate_temp_path()
 
-            if os.path.exists(os.path.join(path, "queue_snapshot")):
+            snapshot_path = os.path.join(path, "queue_snapshot")
+            if _file_size(snapshot_path) > 0:
                 print("Restoring snapshot...")
-                with open(os.path.join(path, "queue_snapshot"), "rb") as file:
+                # Parsed straight from the mapped file, without copying it into a bytes object first.
+                with open(snapshot_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
                     try:
-                        data: StepQueue = pickle.load(file)
-                        print(f"Restored {data}")
-                        self.set_queues(data.get_queues())
-                    except EOFError:
+                        with memoryview(mapped) as view:
+                            data = orjson.loads(view)
+                        self.set_queues([
+                            PriorityQueue([(priority, order, Job.from_tuple(job)) for priority, order, job in queue])
+                            for queue in data["queues"]
+                        ])
+                        self._log_generation = data["generation"]
+                        print(f"Restored {self}")
+                    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
                         print("No snapshot found")
             else:
                 print("No snapshot found")
 
+            replayed = self._replay_log(os.path.join(path, "queue_log"))
+            if replayed is None:
+                self._reset_log()
+            else:
+                self._log_file = open(os.path.join(path, "queue_log"), "r+b")
+                # Drop a record left half written by an interruption.
+                self._log_file.truncate(replayed[1])
+                self._log_file.seek(replayed[1])
+                self._dirty = replayed[0]
+
+    def _replay_log(self, log_path: str) -> Optional[tuple[int, int]]:
+        """
+        Apply the records of the log to the queues. Must be called while holding every lock.
+
+        Parameters
+        ----------
+        log_path : `str`
+            The path of the log.
+
+        Returns
+        -------
+        `Optional[tuple[int, int]]`
+            The number of records replayed and the size of the log up to the last complete record,
+            or None if there is no log of the current generation.
+        """
+        if _file_size(log_path) == 0:
+            return None
+
+        records = 0
+        with open(log_path, "rb") as file:
+            try:
+                if orjson.loads(file.readline()) != ["log", self._log_generation]:
+                    return None
+            except orjson.JSONDecodeError:
+                return None
+
+            end = file.tell()
+            for line in file:
+                # A record without its line break was left half written.
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = orjson.loads(line)
+                    if record[0] == "add":
+                        _, step, priority, order, job = record[:5]
+                        self._queues[step].add_job(Job.from_tuple(job), priority, order)
+                    # Both "add" and "done" records end with the step and order the job was pulled from, if any.
+                    if len(record) in (2, 6):
+                        pulled_step, pulled_order = record[-1]
+                        self._queues[pulled_step]._remove(pulled_order)
+                except (orjson.JSONDecodeError, IndexError, TypeError, ValueError):
+                    break
+                records += 1
+                end += len(line)
+
+        if records:
+            print(f"Replayed {records} logged changes")
+        return records, end
+
     def get_queues(self):
         """
         Get the queues of the StepQueue object.
@@ -276,17 +603,41 @@ class StepQueue:
         """
         self._queues = queues
 
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['_lock']
-        return state
-
-    def __setstate__(self, state):
-        self.__dict__.update(state)
-        self._lock = threading.Lock()
-
     def __str__(self):
         payload = str()
         for i, queue in enumerate(self._queues):
             payload += f"Step {i}: {queue._queue}\n"
         return payload
+
+
+def _file_size(path: str) -> int:
+    """
+    Get the size of a file, in bytes, with a single stat call.
+
+    Parameters
+    ----------
+    path : `str`
+        The path of the file.
+
+    Returns
+    -------
+    `int`
+        The size of the file, or 0 if it does not exist.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _resolve(future: asyncio.Future) -> None:
+    """
+    Resolve a waiter future, unless it was already resolved or cancelled (e.g. by a timeout).
+
+    Parameters
+    ----------
+    future : `asyncio.Future`
+        The future to resolve.
+    """
+    if not future.done():
+        future.set_result(None)
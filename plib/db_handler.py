@@ -2,57 +2,418 @@
 A module to handle database operations.
 """
 
+import atexit
 import json
-import traceback
-from typing import Optional
+import logging
+import os
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Iterator, Optional
 
-import mysql.connector
+from mysql.connector import HAVE_CEXT, errorcode
+from mysql.connector.errors import ProgrammingError
+from mysql.connector.pooling import MySQLConnectionPool
 
 from plib.terminal import error
 from plib.utils.custom_exceptions import BranchWarning
 from plib.utils.general import getCurrentBranch
 
+logger = logging.getLogger(__name__)
+
+# Connections kept open by the pool of each Database.
+POOL_SIZE = 8
+# Seconds the table names are trusted before asking the server again.
+TABLE_CACHE_TTL = 60
+
+
+# Placeholder groups by number of values, e.g. 3: "(%s, %s, %s)".
+_PLACEHOLDERS: dict[int, str] = {}
+
+
+def _placeholders(count: int) -> str:
+    """
+    Get the placeholder group for a row of values, built once per number of values.
+
+    Parameters
+    ----------
+    count : `int`
+        Number of values of the row.
+
+    Returns
+    -------
+    `str`
+        The placeholders between parentheses, e.g. "(%s, %s)".
+    """
+    placeholders = _PLACEHOLDERS.get(count)
+    if placeholders is None:
+        placeholders = _PLACEHOLDERS[count] = "(" + ", ".join(["%s"] * count) + ")"
+    return placeholders
+
+
+@lru_cache(maxsize=1)
+def _load_credentials() -> tuple[str, str, str, str]:
+    """
+    Load the database credentials once. Each one is taken from its environment variable
+    (DB_HOST, DB_USER, DB_PASS, DB_NAME) if set, otherwise from TOKEN.json, which is only read
+    when some of them are missing.
+
+    Returns
+    -------
+    `tuple[str, str, str, str]`
+        The host, user, password and database name.
+
+    Raises
+    ------
+    `KeyError` or `FileNotFoundError`
+        If TOKEN.json is needed, but does not exist or does not contain the missing credentials.
+    """
+    credentials = [os.environ.get(variable) for variable in ("DB_HOST", "DB_USER", "DB_PASS", "DB_NAME")]
+
+    if None in credentials:
+        with open("TOKEN.json", encoding="utf-8") as file:
+            data = json.load(file)
+        credentials = [value if value is not None else data[key]
+                       for value, key in zip(credentials, ("db_host", "db_user", "db_pass", "db_name"))]
+
+    host, user, password, database = credentials
+    return host, user, password, database
+
+
+@lru_cache(maxsize=256)
+def _where(keys: tuple) -> str:
+    """
+    Build the WHERE clause that matches every key with a placeholder, e.g. " WHERE id = %s AND type = %s".
+
+    Parameters
+    ----------
+    keys : `tuple`
+        Field names to match. If empty, there is no WHERE clause.
+
+    Returns
+    -------
+    `str`
+        The WHERE clause, or an empty string.
+    """
+    if not keys:
+        return ""
+    return " WHERE " + " AND ".join(f"{key} = %s" for key in keys)
+
+
+@lru_cache(maxsize=256)
+def _select_sql(table: str, columns: Optional[tuple], keys: tuple, limit: bool) -> str:
+    """
+    Build a SELECT statement, once per shape. Calls with the same table, columns and condition
+    fields reuse the same string (and so the same prepared statement text).
+
+    Parameters
+    ----------
+    table : `str`
+        Table to select from.
+    columns : `Optional[tuple]`
+        Field names to retrieve, or None for all of them.
+    keys : `tuple`
+        Field names of the conditions.
+    limit : `bool`
+        Whether a LIMIT placeholder is appended.
+
+    Returns
+    -------
+    `str`
+        The statement.
+    """
+    sql = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}{_where(keys)}"
+    if limit:
+        sql += " LIMIT %s"
+    return sql
+
+
+@lru_cache(maxsize=256)
+def _delete_sql(table: str, keys: tuple) -> str:
+    """
+    Build a DELETE statement, once per table and condition fields.
+
+    Parameters
+    ----------
+    table : `str`
+        Table to delete from.
+    keys : `tuple`
+        Field names of the conditions.
+
+    Returns
+    -------
+    `str`
+        The statement.
+    """
+    return f"DELETE FROM {table}{_where(keys)}"
+
+
+def _close_cursor(cursor) -> None:
+    """
+    Close a cached cursor, ignoring errors, as its connection could be gone already.
+
+    Parameters
+    ----------
+    cursor : `Optional[MySQLCursor]`
+        The cursor, or None.
+    """
+    if cursor is None:
+        return
+    try:
+        cursor.close()
+    except Exception: # pylint: disable=broad-exception-caught
+        pass
+
 
 class Database:
     """
     A class to handle database operations.
 
+    Values are always sent as bound parameters of server-side prepared statements, never formatted into the SQL.
+    Table and field names are still formatted, so they must not come from user input.
+
+    Connections are taken from a pool (`POOL_SIZE` connections) for each operation and given back
+    right after, so concurrent callers do not share a single socket, and a dropped connection
+    is reconnected by the pool on checkout.
+
     Raises
     ------
     `KeyError` or `FileNotFoundError`
-        If the file TOKEN.json does not exist or does not contain the database credentials.
+        If the file TOKEN.json does not exist or does not contain the database credentials,
+        and they are not set in the environment either.
     """
     def __init__(self) -> None:
-        self.mainDb = None
+        self._pool: Optional[MySQLConnectionPool] = None
+        self._main_db = None
+        self._table_cache: Optional[set[str]] = None
+        self._table_cache_ts = 0.0
+        self._branch: Optional[str] = None
+        self._cursors: dict[tuple, Any] = {}
+        atexit.register(self._close_cursors)
         self.connect()
         self.attempts = 0
 
     def connect(self) -> None:
+        """
+        Create the connection pool with the database credentials (see `_load_credentials`).
+
+        Does nothing if the pool already exists: it reconnects dropped connections on checkout by itself,
+        and a new pool would open `POOL_SIZE` connections while orphaning the old ones.
+        """
+        if self._pool is not None:
+            return
+
         try:
-            with open("TOKEN.json", encoding="utf-8") as file:
-                data = json.load(file)
-                host = data["db_host"]
-                user = data["db_user"]
-                password = data["db_pass"]
-                database = data["db_name"]
-
-            self.mainDb = mysql.connector.connect(
+            host, user, password, database = _load_credentials()
+
+            self._pool = MySQLConnectionPool(
+                pool_name= "cg",
+                pool_size= POOL_SIZE,
                 host= host,
                 user= user,
                 password= password,
-                database= database
+                database= database,
+                autocommit= False,
+                # Rows are decoded by the C extension when it is installed.
+                use_pure= not HAVE_CEXT,
+                compress= True,
+                charset= "utf8mb4",
+                collation= "utf8mb4_unicode_ci",
+                # Skips a round trip per checkout, _conn() ends any open transaction instead.
+                pool_reset_session= False
             )
-            
+            self._main_db = None
+
         except (KeyError, FileNotFoundError) as e:
-            error(e, traceback.format_exc(), "Database credentials not found",
-                  "Please make sure that the file TOKEN.json exists and contains the database credentials.", level="WARNING")
-            self.mainDb = None
+            error(e, message="Database credentials not found",
+                  advice="Please make sure that the file TOKEN.json exists and contains the database credentials, "
+                         "or set them in the DB_HOST, DB_USER, DB_PASS and DB_NAME environment variables.", level="WARNING")
+            self._pool = None
+            self._main_db = None
             raise
 
-    def _check_table(self, table: str, attempt: int = 0) -> bool:
+    @property
+    def mainDb(self):
+        """
+        Legacy single connection, checked out from the pool on first use and kept.
+        Prefer the methods of this class, which use a pooled connection per operation.
+        """
+        if self._main_db is None:
+            self._main_db = self._pool.get_connection()
+        return self._main_db
+
+    @contextmanager
+    def _conn(self, conn=None):
+        """
+        Check out a connection from the pool, giving it back (closing it) on exit.
+        A transaction left open (e.g. by a read, or by an error before the commit) is rolled back,
+        so the next user of the connection does not inherit it.
+
+        If a connection is given (that of a transaction), it is used as is, and left to its owner.
+
+        Parameters
+        ----------
+        conn : `PooledMySQLConnection, optional`
+            Connection to use instead of checking out one, by default `None`
+
+        Yields
+        ------
+        `PooledMySQLConnection`
+            The pooled connection.
+        """
+        if conn is not None:
+            yield conn
+            return
+
+        cn = self._pool.get_connection()
+        try:
+            yield cn
+        finally:
+            try:
+                if cn.in_transaction:
+                    cn.rollback()
+            finally:
+                cn.close()
+
+    def refresh_branch(self) -> str:
+        """
+        Read the current git branch again. It is read once and cached,
+        as it is not expected to change while the program runs.
+
+        Returns
+        -------
+        `str`
+            The current branch.
+        """
+        self._branch = getCurrentBranch()
+        return self._branch
+
+    def _check_branch(self) -> None:
+        """
+        Check that the current branch is `main` before changing the database.
+
+        Raises
+        ------
+        `BranchWarning`
+            If the current branch is not `main`.
+        """
+        branch = self._branch if self._branch is not None else self.refresh_branch()
+        if branch != "main":
+            try:
+                raise BranchWarning(branch=branch)
+            except BranchWarning as e:
+                error(e, message="Not on main branch",
+                      advice="Please switch to the main branch to update the database.", level="WARNING")
+                raise
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several operations in a single transaction, committed once on exit,
+        or rolled back if an exception is raised.
+
+        ej:
+            with db.transaction() as tx:
+                for row in rows:
+                    tx.insert("TABLE", names, row)
+
+        Yields
+        ------
+        `Transaction`
+            The same operations of this class, bound to the connection of the transaction.
+        """
+        with self._conn() as cn:
+            try:
+                yield Transaction(self, cn)
+            except BaseException:
+                cn.rollback()
+                raise
+            cn.commit()
+
+    def _cursor(self, cn, prepared: bool = False):
+        """
+        Get the cursor of a connection, created on first use and reused by the next operations on it.
+
+        Cursors are cached by underlying connection (pooled wrappers are new on every checkout)
+        and by server session, so a reconnected connection gets new cursors, and the ones of its old session are closed.
+        Only the user of a checked out connection uses its cursors, so they are never shared at the same time.
+
+        Parameters
+        ----------
+        cn : `PooledMySQLConnection`
+            The connection.
+        prepared : `bool, optional`
+            Whether a cursor for prepared statements is wanted, by default `False`
+
+        Returns
+        -------
+        `MySQLCursor`
+            The cursor.
+        """
+        cnx = getattr(cn, "_cnx", cn)
+        key = (id(cnx), cnx.connection_id, prepared)
+        cursor = self._cursors.get(key)
+        if cursor is None:
+            for stale in [k for k in list(self._cursors) if k[0] == key[0] and k[1] != key[1]]:
+                _close_cursor(self._cursors.pop(stale, None))
+            cursor = self._cursors[key] = cn.cursor(prepared=prepared)
+        return cursor
+
+    def _close_cursors(self) -> None:
+        """
+        Close every cached cursor. Called when the program exits.
+        """
+        cursors, self._cursors = self._cursors, {}
+        for cursor in cursors.values():
+            _close_cursor(cursor)
+
+    def _execute(self, cursor, table: str, sql: str, params=(), many: bool = False) -> None:
+        """
+        Execute a statement on a table.
+
+        There is no previous check of the table, so the happy path is a single round trip.
+        If the server reports that the table does not exist, the cached table names are
+        forgotten and `NameError` is raised instead.
+
+        Parameters
+        ----------
+        cursor : `MySQLCursor`
+            The cursor to execute the statement with.
+        table : `str`
+            The table of the statement, for the error message.
+        sql : `str`
+            The statement.
+        params : `tuple, optional`
+            The values bound to the placeholders of the statement, by default `()`.
+            If many, a sequence of them.
+        many : `bool, optional`
+            Whether the statement is executed once per element of params, by default `False`.
+
+        Raises
+        ------
+        `NameError`
+            If the table does not exist.
+        """
+        try:
+            if many:
+                cursor.executemany(sql, params)
+            else:
+                cursor.execute(sql, params)
+        except ProgrammingError as e:
+            if e.errno == errorcode.ER_NO_SUCH_TABLE:
+                self._table_cache = None
+                raise NameError(f"Table {table} does not exist.") from e
+            raise
+
+    def check_table(self, table: str, attempt: int = 0) -> bool:
         """
         Checks if a table exists in the database.
 
+        The operations of this class do not need it, they raise `NameError` when the table does not exist.
+
+        Existing tables are cached for `TABLE_CACHE_TTL` seconds. A miss asks the server
+        for that single table, so a table created meanwhile is found.
+
         Parameters
         ----------
         table : `str`
@@ -63,28 +424,41 @@ class Database:
         `bool`
             True or False depending on whether the table exists or not.
         """
-        try:
-            cursor = self.mainDb.cursor()
+        if self._table_cache is None or time.monotonic() - self._table_cache_ts >= TABLE_CACHE_TTL:
+            self._table_cache = set()
+            self._table_cache_ts = time.monotonic()
+        elif table in self._table_cache:
+            return True
 
-            cursor.execute("SELECT table_name FROM information_schema.tables")
+        try:
+            with self._conn() as cn:
+                cursor = self._cursor(cn, prepared=True)
 
-            tabes = cursor.fetchall()
+                cursor.execute(
+                    "SELECT 1 FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s LIMIT 1",
+                    (table,)
+                )
 
-            for table_name in tabes:
-                if table in table_name:
-                    return True
+                exists = cursor.fetchone() is not None
+                # Consume the end of the result, so the cursor can be reused.
+                cursor.fetchall()
 
-            return False
+            if exists:
+                self._table_cache.add(table)
+            return exists
         except Exception as e:
             if attempt < 3:
-                self.connect()
-                return self._check_table(table=table, attempt=attempt + 1)
+                # The pool reconnects broken connections on checkout.
+                return self.check_table(table=table, attempt=attempt + 1)
             else:
-                error(e, traceback.format_exc(), "Error checking table", level="ERROR")
+                error(e, message="Error checking table", level="ERROR")
                 return False
 
 
-    def insert(self, table: str, names: list, values: list, retrieve_id: bool = False):
+    # Former name, kept for existing callers.
+    _check_table = check_table
+
+    def insert(self, table: str, names: list, values: list, retrieve_id: bool = False, conn=None):
         """
         Inserts a register into a table.
         
@@ -96,6 +470,11 @@ class Database:
             Field names. ej: ["name1", "age1", "name2", "age2"]
         values : `list`
             Field values. ej: ["John", 20, "Mary", 21]
+        retrieve_id : `bool, optional`
+            If True, the id of the inserted register is returned, by default `False`
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on. If undefined, a pooled connection
+            is used and the change is committed right away, by default `None`
         
         Raises
         ------
@@ -105,38 +484,79 @@ class Database:
             If the current branch is not `main`.
             This is to prevent accidental changes to the database.
         """
-        if not self._check_table(table=table):
-            raise NameError(f"Table {table} does not exist.")
-
-        cursor = self.mainDb.cursor()
+        names_str = "(" + ", ".join(names) + ")"
+        values_str = _placeholders(len(values))
 
-        names_str = "("
-        for name_index, name in enumerate(names):
-            if name_index > 0:
-                names_str += ", "
-            names_str += name
-        names_str += ")"
+        sql = f"INSERT INTO {table} {names_str} VALUES {values_str}"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("sql=%s", sql)
 
-        values_str = "("
-        for value_index, _ in enumerate(values):
-            if value_index > 0:
-                values_str += ", "
-            values_str += r"%s"
-        values_str += ")"
-        print(values_str)
+        with self._conn(conn) as cn:
+            cursor = self._cursor(cn)
 
-        sql = f"INSERT INTO {table} {names_str} VALUES {values_str}"
-        print(sql)
+            self._execute(cursor, table, sql, values)
 
-        cursor.execute(sql, values)
+            if conn is None:
+                cn.commit()
 
-        self.mainDb.commit()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s record(s) affected", cursor.rowcount)
+            last_id = cursor.lastrowid
 
-        print(cursor.rowcount, "record(s) affected")
         if retrieve_id:
-            return cursor.lastrowid
+            return last_id
+
+    def insert_many(self, table: str, names: list, rows: list[list], batch: int = 1000, conn=None) -> int:
+        """
+        Inserts several registers into a table, sending up to `batch` registers per statement.
 
-    def select(self, table: str, conditions: Optional[dict] = None):
+        Much faster than calling `insert` for each register, as every batch is a single
+        multi-row INSERT, a single round trip and a single commit (unless run in a transaction).
+        
+        Parameters
+        ----------
+        table : `str`
+            Which table to insert the registers into.
+        names : `list`
+            Field names, shared by every register. ej: ["name", "age"]
+        rows : `list[list]`
+            Field values of each register. ej: [["John", 20], ["Mary", 21]]
+        batch : `int, optional`
+            Maximum number of registers per statement, by default `1000`.
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on. If undefined, a pooled connection
+            is used and the change is committed right away, by default `None`
+        
+        Returns
+        -------
+        `int`
+            Number of registers inserted.
+        
+        Raises
+        ------
+        `NameError`
+            If the table does not exist.
+        """
+        sql = f"INSERT INTO {table} ({', '.join(names)}) VALUES {_placeholders(len(names))}"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("sql=%s", sql)
+
+        inserted = 0
+        with self._conn(conn) as cn:
+            cursor = self._cursor(cn)
+
+            for start in range(0, len(rows), batch):
+                # executemany() rewrites the INSERT into a single multi-row statement.
+                self._execute(cursor, table, sql, rows[start:start + batch], many=True)
+                if conn is None:
+                    cn.commit()
+                inserted += cursor.rowcount
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s record(s) affected", inserted)
+        return inserted
+
+    def select(self, table: str, conditions: Optional[dict] = None, stream: bool = False, limit: Optional[int] = None, conn=None):
         """
         Selects registers from a table.        
         
@@ -147,39 +567,123 @@ class Database:
         conditions : `dict, optional`
             A dictionary as {Field_name: Field_values} to filter among registers.
             If undefined, then all registers from table would be returned, by default `None`
+        stream : `bool, optional`
+            If True, registers are fetched from the server while they are iterated,
+            instead of loading all of them in memory first, by default `False`
+        limit : `int, optional`
+            Maximum number of registers to retrieve. If undefined, there is no limit, by default `None`
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on.
+            If undefined, a pooled connection is used, by default `None`
         
         Returns
         -------
-        `list[(tuple,)]`
+        `list[(tuple,)]` or `Iterator[tuple]`
             list of registers as tuples. Could be empty.
             Could be other type format depending on the table.
+            If stream, an iterator over the registers instead. It keeps a pooled connection
+            until it is exhausted or closed.
         
         Raises
         ------
         `NameError`
             If the table does not exist.
         """
-        if not self._check_table(table=table):
-            raise NameError(f"Table {table} does not exist.")
-        cursor = self.mainDb.cursor()
+        keys = tuple(conditions) if conditions else ()
+        sql = _select_sql(table, None, keys, limit is not None)
+        params = tuple(conditions.values()) if conditions else ()
+        if limit is not None:
+            params += (limit,)
 
-        sql = f"SELECT * FROM {table}"
+        if stream:
+            return self._stream(table, sql, params, conn)
 
-        if conditions:
-            sql += " WHERE "
+        with self._conn(conn) as cn:
+            cursor = self._cursor(cn, prepared=True)
 
-            for condition_index, condition in enumerate(conditions):
-                if condition_index > 0:
-                    sql += " AND "
-                sql += f"{condition} = \"{conditions[condition]}\""
+            self._execute(cursor, table, sql, params)
 
-        cursor.execute(sql)
+            payload = cursor.fetchall()
 
-        payload = cursor.fetchall()
+        return payload
+
+    def _stream(self, table: str, sql: str, params: tuple, conn=None) -> Iterator[tuple]:
+        """
+        Execute a query on an unbuffered cursor and yield its registers as they arrive.
+
+        Parameters
+        ----------
+        table : `str`
+            The table of the query, for the error message.
+        sql : `str`
+            The query.
+        params : `tuple`
+            The values bound to the placeholders of the query.
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on.
+            If undefined, a pooled connection is used, by default `None`
+
+        Yields
+        ------
+        `tuple`
+            Each register.
+        """
+        with self._conn(conn) as cn:
+            # Not the cached cursor, the caller could run other queries on a transaction meanwhile.
+            cursor = cn.cursor(prepared=True)
+
+            self._execute(cursor, table, sql, params)
+            try:
+                yield from cursor
+            finally:
+                # Left unread if the caller stopped early, it must be read before the connection is reused.
+                for _ in cursor:
+                    pass
+                # Deallocates the prepared statement, the session is not reset when the connection is reused.
+                cursor.close()
+
+    def select_columns(self, table: str, columns: list, conditions: Optional[dict] = None, conn=None):
+        """
+        Selects only some fields of registers from a table.
+        Useful to avoid transferring heavy fields (e.g. BLOBs) that are not needed.
+        
+        Parameters
+        ----------
+        table : `str`
+            Which table to select the register or registers from.
+        columns : `list`
+            Field names to retrieve, in order. ej: ["id", "name"]
+        conditions : `dict, optional`
+            A dictionary as {Field_name: Field_values} to filter among registers.
+            If undefined, then all registers from table would be returned, by default `None`
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on.
+            If undefined, a pooled connection is used, by default `None`
+        
+        Returns
+        -------
+        `list[(tuple,)]`
+            list of registers as tuples, with the fields in the same order as columns. Could be empty.
+        
+        Raises
+        ------
+        `NameError`
+            If the table does not exist.
+        """
+        keys = tuple(conditions) if conditions else ()
+        sql = _select_sql(table, tuple(columns), keys, False)
+        params = tuple(conditions.values()) if conditions else ()
+
+        with self._conn(conn) as cn:
+            cursor = self._cursor(cn, prepared=True)
+
+            self._execute(cursor, table, sql, params)
+
+            payload = cursor.fetchall()
 
         return payload
 
-    def update(self, table: str, key_name: str, key_value: str, value_name: str, value_value: int):
+    def update(self, table: str, key_name: str, key_value: str, value_name: str, value_value: int, conn=None):
         """
         Updates a field value from a register.
 
@@ -195,6 +699,9 @@ class Database:
             Field name to update.
         value_value : `int`
             Field value to update.
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on. If undefined, a pooled connection
+            is used and the change is committed right away, by default `None`
         
         Raises
         ------
@@ -204,30 +711,25 @@ class Database:
             If the current branch is not `main`.
             This is to prevent accidental changes to the database.
         """
-        if not self._check_table(table=table):
-            raise NameError(f"Table {table} does not exist.")
+        self._check_branch()
 
-        if getCurrentBranch() != "main":
-            try:
-                raise BranchWarning(branch=getCurrentBranch())
-            except BranchWarning as e:
-                error(e, traceback.format_exc(), "Not on main branch",
-                      "Please switch to the main branch to update the database.", level="WARNING")
-                raise
+        sql = f"UPDATE {table} SET {value_name} = %s WHERE {key_name} = %s"
 
-        cursor = self.mainDb.cursor()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("sql=%s", sql)
 
-        sql = f"UPDATE {table} SET {value_name} = {value_value} WHERE {key_name} = \"{key_value}\""
+        with self._conn(conn) as cn:
+            cursor = self._cursor(cn, prepared=True)
 
-        print(sql)
+            self._execute(cursor, table, sql, (value_value, key_value))
 
-        cursor.execute(sql)
+            if conn is None:
+                cn.commit()
 
-        self.mainDb.commit()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s record(s) affected", cursor.rowcount)
 
-        print(cursor.rowcount, "record(s) affected")
-
-    def delete(self, table: str, conditions: dict):
+    def delete(self, table: str, conditions: dict, conn=None):
         """
         Deletes a register or registers from a table.
 
@@ -241,6 +743,9 @@ class Database:
             Which table to delete the register or registers from.
         conditions : `dict`
             A dictionary as {Field_name: Field_values} to filter among registers.
+        conn : `PooledMySQLConnection, optional`
+            Connection of a transaction (see `transaction`) to run on. If undefined, a pooled connection
+            is used and the change is committed right away, by default `None`
         
         Raises
         ------
@@ -252,33 +757,51 @@ class Database:
         `ValueError`
             If conditions is empty.
         """
-        if not self._check_table(table=table):
-            raise NameError(f"Table {table} does not exist.")
-
-        if getCurrentBranch() != "main":
-            try:
-                raise BranchWarning(branch=getCurrentBranch())
-            except BranchWarning as e:
-                error(e, traceback.format_exc(), "Not on main branch",
-                      "Please switch to the main branch to update the database.", level="WARNING")
-                raise
+        self._check_branch()
 
         if not conditions:
             raise ValueError("Conditions can't be empty.")
 
-        cursor = self.mainDb.cursor()
+        sql = _delete_sql(table, tuple(conditions))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("sql=%s", sql)
+
+        with self._conn(conn) as cn:
+            cursor = self._cursor(cn, prepared=True)
+
+            self._execute(cursor, table, sql, tuple(conditions.values()))
+
+            if conn is None:
+                cn.commit()
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s record(s) affected", cursor.rowcount)
+
+
+class Transaction:
+    """
+    Operations of a `Database`, bound to the connection of a transaction. Returned by `Database.transaction`.
+    Nothing is committed until the transaction ends.
+    """
+    def __init__(self, db: Database, cn) -> None:
+        self._db = db
+        self._cn = cn
 
-        sql = f"DELETE FROM {table} WHERE "
+    def insert(self, *args, **kwargs):
+        return self._db.insert(*args, conn=self._cn, **kwargs)
 
-        for condition_index, condition in enumerate(conditions):
-            if condition_index > 0:
-                sql += " AND "
-            sql += f"{condition} = \"{conditions[condition]}\""
+    def insert_many(self, *args, **kwargs):
+        return self._db.insert_many(*args, conn=self._cn, **kwargs)
 
-        print(sql)
+    def select(self, *args, **kwargs):
+        return self._db.select(*args, conn=self._cn, **kwargs)
 
-        cursor.execute(sql)
+    def select_columns(self, *args, **kwargs):
+        return self._db.select_columns(*args, conn=self._cn, **kwargs)
 
-        self.mainDb.commit()
+    def update(self, *args, **kwargs):
+        return self._db.update(*args, conn=self._cn, **kwargs)
 
-        print(cursor.rowcount, "record(s) affected")
+    def delete(self, *args, **kwargs):
+        return self._db.delete(*args, conn=self._cn, **kwargs)
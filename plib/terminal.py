@@ -978,7 +978,7 @@ class CustomStderr:
 
 def error(
     exception: Exception,
-    traceback_format_exc: str,
+    traceback_format_exc: str | None = None,
     message: str | None = None,
     advice: str | None = None,
     level: str | int = "ERROR"
@@ -996,10 +996,12 @@ def error(
         For example, `except ValueError as exception`: where `exception` should
         be this parameter.
     
-    traceback_format_exc : `str`
-        The traceback. Always should be a string.
+    traceback_format_exc : `str | None, optional`
+        The traceback, as a string, by default None.
 
-        Is recommended to use `traceback.format_exc()` but it is not the only way.
+        If None, it is formatted from the traceback attached to `exception`,
+        so callers do not need to call `traceback.format_exc()` themselves.
+        It is always formatted, as the traceback is printed to the terminal whatever the logging level.
         See traceback module's documentation for more information.
     
     message : `str | None, optional`
@@ -1030,6 +1032,10 @@ def error(
     else:
         concatenator = " --> "
 
+    # Not gated on the logging level: the traceback is printed to the terminal in any case.
+    if traceback_format_exc is None:
+        traceback_format_exc = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+
     # Adding adive to the end of the traceback. Only if there is a advice.
     if advice is None:
         advice = ""